@@ -1,3 +1,5 @@
+import inspect
+
 import numpy as np
 
 from nnunetv2.training.loss.compound_losses import DC_and_BCE_loss, DC_and_CE_loss
@@ -5,19 +7,77 @@ from nnunetv2.training.loss.deep_supervision import DeepSupervisionWrapper
 from nnunetv2.training.loss.dice import MemoryEfficientSoftDiceLoss
 from nnunetv2.training.nnUNetTrainer.nnUNetTrainer import nnUNetTrainer
 from nnunetv2.training.nnUNetTrainer.nnUNetTrainer_window import nnUNetTrainer_window
+from nnunetv2.training.lr_scheduler.polylr import PolyLRScheduler
 import torch
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 
 
 class STUNetTrainer(nnUNetTrainer_window):
+    # set to False in a subclass if you need reproducible conv algorithm selection
+    cudnn_benchmark = True
+    # TF32 for the convs and matmuls that still run in fp32 (everything outside of autocast, or all of them on GPUs
+    # without bf16 support). Independent of the bf16 autocast below, the two compose
+    allow_tf32 = True
+    # STUNet size. The variants below only differ in these, see build_network_architecture
+    stunet_depth = 1
+    stunet_base_dim = 32
+    stunet_checkpoint_levels = ()
+    # number of deep supervision outputs used for training, None means all of them
+    stunet_deep_supervision_outputs = None
+
     def __init__(self, plans: dict, configuration: str, fold: int, dataset_json: dict, unpack_dataset: bool = True,
                  device: torch.device = torch.device('cuda')):
         super().__init__(plans, configuration, fold, dataset_json, unpack_dataset, device)
         self.num_epochs = 1000
         self.initial_lr = 1e-2
-
-    @staticmethod
-    def build_network_architecture(plans_manager,
+        # STUNet issues many small kernels per block. With nnUNet_compile=True, reduce-overhead replays them as cuda
+        # graphs
+        self.compile_mode = 'reduce-overhead'
+        # the patch size is fixed per plan, so there is no point in tracing symbolic shapes. Every shape we encounter
+        # gets its own fully specialized graph
+        self.compile_dynamic = False
+        # STUNet only has InstanceNorm without running stats, so there are no buffers to broadcast. The set of
+        # parameters receiving gradients is the same in every iteration, which lets DDP plan its allreduce once.
+        # Letting the gradients alias the allreduce buckets saves one copy and a parameter sized allocation
+        self.ddp_kwargs = {'broadcast_buffers': False, 'gradient_as_bucket_view': True, 'static_graph': True}
+
+        # only use bf16 on GPUs with native bf16 tensor cores (Ampere and newer). torch.cuda.is_bf16_supported() also
+        # returns True for emulated bf16 on Volta/Turing, which would be a lot slower than fp16 there
+        if self.device.type == 'cuda' and torch.cuda.get_device_capability(self.device)[0] >= 8:
+            # bf16 has the same exponent range as fp32, so we neither risk overflows nor need loss scaling
+            self.autocast_dtype = torch.bfloat16
+            self.grad_scaler = None
+
+    def initialize(self):
+        if self._do_i_compile():
+            # training, validation and sliding window inference each bring their own input shape, so we raise the
+            # dynamo cache size to make sure these don't keep evicting each other. This is a process wide setting, so
+            # we only touch it if we actually compile
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+        super().initialize()
+
+    def on_train_start(self):
+        if self.device.type == 'cuda':
+            # patch sizes are fixed for a given plan, so cudnn autotuning converges after the first iterations. This
+            # is done here because run_training sets cudnn.benchmark after creating (and, when continuing or loading
+            # pretrained weights, initializing) the trainer, right before run_training
+            torch.backends.cudnn.benchmark = self.cudnn_benchmark
+            torch.backends.cudnn.allow_tf32 = self.allow_tf32
+            torch.backends.cuda.matmul.allow_tf32 = self.allow_tf32
+        super().on_train_start()
+
+    def _get_deep_supervision_scales(self):
+        deep_supervision_scales = super()._get_deep_supervision_scales()
+        if deep_supervision_scales is not None and self.stunet_deep_supervision_outputs is not None:
+            # the network only computes this many (highest resolution) outputs, so the data augmentation does not need
+            # to create downsampled targets for the others
+            deep_supervision_scales = deep_supervision_scales[:self.stunet_deep_supervision_outputs]
+        return deep_supervision_scales
+
+    @classmethod
+    def build_network_architecture(cls,
+                                   plans_manager,
                                    dataset_json,
                                    configuration_manager,
                                    num_input_channels,
@@ -30,9 +90,24 @@ class STUNetTrainer(nnUNetTrainer_window):
             strides = strides[:5]
         while len(strides) < 5:
             strides.append([1, 1, 1])
-        return STUNet(num_input_channels, num_classes, depth=[1] * 6, dims=[32 * x for x in [1, 2, 4, 8, 16, 16]],
+        return STUNet(num_input_channels, num_classes, depth=cls.stunet_depth,
+                      dims=[cls.stunet_base_dim * x for x in [1, 2, 4, 8, 16, 16]],
                       pool_op_kernel_sizes=strides, conv_kernel_sizes=kernel_sizes,
-                      enable_deep_supervision=enable_deep_supervision)
+                      enable_deep_supervision=enable_deep_supervision,
+                      checkpoint_levels=cls.stunet_checkpoint_levels,
+                      num_deep_supervision_outputs=cls.stunet_deep_supervision_outputs)
+
+    def configure_optimizers(self):
+        # the fused implementation updates all parameters in a single kernel. Not available in older torch versions, in
+        # which case we at least want the multi tensor (foreach) implementation instead of a python loop over params
+        if self.device.type == 'cuda' and 'fused' in inspect.signature(torch.optim.SGD).parameters:
+            impl = {'fused': True}
+        else:
+            impl = {'foreach': True}
+        optimizer = torch.optim.SGD(self.network.parameters(), self.initial_lr, weight_decay=self.weight_decay,
+                                    momentum=0.99, nesterov=True, **impl)
+        lr_scheduler = PolyLRScheduler(optimizer, self.initial_lr, self.num_epochs, exponent=3.)
+        return optimizer, lr_scheduler
 
     def _build_loss(self):
         if self.label_manager.has_regions:
@@ -53,37 +128,21 @@ class STUNetTrainer(nnUNetTrainer_window):
         if self.enable_deep_supervision:
             deep_supervision_scales = self._get_deep_supervision_scales()
             weights = np.array([1 / (2 ** i) for i in range(len(deep_supervision_scales))])
-            if self.is_ddp and not self._do_i_compile():
-                # very strange and stupid interaction. DDP crashes and complains about unused parameters due to
-                # weights[-1] = 0. Interestingly this crash doesn't happen with torch.compile enabled. Strange stuff.
-                # Anywho, the simple fix is to set a very low weight to this.
-                weights[-1] = 1e-6
-            else:
+            # with stunet_deep_supervision_outputs, the network only computes the highest resolution outputs and we use
+            # all of them. Otherwise the lowest resolution output is not used. Its seg head then receives no gradient,
+            # which DDP accepts because we run it with static_graph=True (see ddp_kwargs)
+            if self.stunet_deep_supervision_outputs is None:
                 weights[-1] = 0
 
-            # we don't use the lowest 2 outputs. Normalize weights so that they sum to 1
+            # normalize weights so that they sum to 1
             weights = weights / weights.sum()
             # now wrap the loss
             loss = DeepSupervisionWrapper(loss, weights)
         return loss
+
+
 class STUNetTrainer_small(STUNetTrainer):
-    @staticmethod
-    def build_network_architecture(plans_manager,
-                                   dataset_json,
-                                   configuration_manager,
-                                   num_input_channels,
-                                   enable_deep_supervision: bool = True) -> nn.Module:
-        label_manager = plans_manager.get_label_manager(dataset_json)
-        num_classes = label_manager.num_segmentation_heads
-        kernel_sizes = [[3, 3, 3]] * 6
-        strides = configuration_manager.pool_op_kernel_sizes[1:]
-        if len(strides) > 5:
-            strides = strides[:5]
-        while len(strides) < 5:
-            strides.append([1, 1, 1])
-        return STUNet(num_input_channels, num_classes, depth=[1] * 6, dims=[16 * x for x in [1, 2, 4, 8, 16, 16]],
-                      pool_op_kernel_sizes=strides, conv_kernel_sizes=kernel_sizes,
-                      enable_deep_supervision=enable_deep_supervision)
+    stunet_base_dim = 16
 
 
 class STUNetTrainer_small_ft(STUNetTrainer_small):
@@ -95,23 +154,8 @@ class STUNetTrainer_small_ft(STUNetTrainer_small):
 
 
 class STUNetTrainer_base(STUNetTrainer):
-    @staticmethod
-    def build_network_architecture(plans_manager,
-                                   dataset_json,
-                                   configuration_manager,
-                                   num_input_channels,
-                                   enable_deep_supervision: bool = True) -> nn.Module:
-        label_manager = plans_manager.get_label_manager(dataset_json)
-        num_classes = label_manager.num_segmentation_heads
-        kernel_sizes = [[3, 3, 3]] * 6
-        strides = configuration_manager.pool_op_kernel_sizes[1:]
-        if len(strides) > 5:
-            strides = strides[:5]
-        while len(strides) < 5:
-            strides.append([1, 1, 1])
-        return STUNet(num_input_channels, num_classes, depth=[1] * 6, dims=[32 * x for x in [1, 2, 4, 8, 16, 16]],
-                      pool_op_kernel_sizes=strides, conv_kernel_sizes=kernel_sizes,
-                      enable_deep_supervision=enable_deep_supervision)
+    stunet_depth = 1
+    stunet_base_dim = 32
 
 
 class STUNetTrainer_base_ft(STUNetTrainer_base):
@@ -122,28 +166,16 @@ class STUNetTrainer_base_ft(STUNetTrainer_base):
         self.num_epochs = 2500
 
 
-
 class STUNetTrainer_large(STUNetTrainer):
-    @staticmethod
-    def build_network_architecture(plans_manager,
-                                   dataset_json,
-                                   configuration_manager,
-                                   num_input_channels,
-                                   enable_deep_supervision: bool = True) -> nn.Module:
-        label_manager = plans_manager.get_label_manager(dataset_json)
-        num_classes = label_manager.num_segmentation_heads
-        kernel_sizes = [[3, 3, 3]] * 6
-        strides = configuration_manager.pool_op_kernel_sizes[1:]
-        if len(strides) > 5:
-            strides = strides[:5]
-        while len(strides) < 5:
-            strides.append([1, 1, 1])
-        return STUNet(num_input_channels, num_classes, depth=[2] * 6, dims=[64 * x for x in [1, 2, 4, 8, 16, 16]],
-                      pool_op_kernel_sizes=strides, conv_kernel_sizes=kernel_sizes,
-                      enable_deep_supervision=enable_deep_supervision)
+    stunet_depth = 2
+    stunet_base_dim = 64
+    stunet_deep_supervision_outputs = 3
 
 
 class STUNetTrainer_large_ft(STUNetTrainer_large):
+    # fine-tuning keeps all deep supervision outputs, as in the published STUNet fine-tuning recipe
+    stunet_deep_supervision_outputs = None
+
     def __init__(self, plans: dict, configuration: str, fold: int, dataset_json: dict, unpack_dataset: bool = True,
                  device: torch.device = torch.device('cuda')):
         super().__init__(plans, configuration, fold, dataset_json, unpack_dataset, device)
@@ -152,26 +184,15 @@ class STUNetTrainer_large_ft(STUNetTrainer_large):
 
 
 class STUNetTrainer_huge(STUNetTrainer):
-    @staticmethod
-    def build_network_architecture(plans_manager,
-                                   dataset_json,
-                                   configuration_manager,
-                                   num_input_channels,
-                                   enable_deep_supervision: bool = True) -> nn.Module:
-        label_manager = plans_manager.get_label_manager(dataset_json)
-        num_classes = label_manager.num_segmentation_heads
-        kernel_sizes = [[3, 3, 3]] * 6
-        strides = configuration_manager.pool_op_kernel_sizes[1:]
-        if len(strides) > 5:
-            strides = strides[:5]
-        while len(strides) < 5:
-            strides.append([1, 1, 1])
-        return STUNet(num_input_channels, num_classes, depth=[3] * 6, dims=[96 * x for x in [1, 2, 4, 8, 16, 16]],
-                      pool_op_kernel_sizes=strides, conv_kernel_sizes=kernel_sizes,
-                      enable_deep_supervision=enable_deep_supervision)
+    stunet_depth = 3
+    stunet_base_dim = 96
+    stunet_deep_supervision_outputs = 3
 
 
 class STUNetTrainer_huge_ft(STUNetTrainer_huge):
+    # fine-tuning keeps all deep supervision outputs, as in the published STUNet fine-tuning recipe
+    stunet_deep_supervision_outputs = None
+
     def __init__(self, plans: dict, configuration: str, fold: int, dataset_json: dict, unpack_dataset: bool = True,
                  device: torch.device = torch.device('cuda')):
         super().__init__(plans, configuration, fold, dataset_json, unpack_dataset, device)
@@ -179,6 +200,47 @@ class STUNetTrainer_huge_ft(STUNetTrainer_huge):
         self.num_epochs = 1000
 
 
+class STUNetTrainer_huge_ckpt(STUNetTrainer_huge):
+    """
+    STUNet huge with activation checkpointing on the two highest resolution levels. Use this if STUNet huge does not
+    fit in your GPU memory. Like STUNetTrainer_huge, it trains with the three highest resolution deep supervision
+    outputs.
+    """
+    stunet_checkpoint_levels = (0, 1)
+
+
+class STUNetTrainer_huge_accum(STUNetTrainer_huge):
+    """
+    STUNet huge with half the planned batch size per forward pass. Gradients of two passes are accumulated before each
+    optimizer step and the number of iterations per epoch is doubled, so the effective batch size and the number of
+    optimizer steps per epoch are those of STUNetTrainer_huge. Use this if STUNet huge does not fit in your GPU memory
+    and you would rather not recompute activations like STUNetTrainer_huge_ckpt does. Like STUNetTrainer_huge, it
+    trains with the three highest resolution deep supervision outputs.
+
+    This is not exactly equivalent to STUNetTrainer_huge:
+    - nnU-Net forces foreground in the last round(batch_size * 0.33) samples of every batch, which does not survive
+    halving the batch size (a batch of 2 has one forced foreground patch, a micro batch of 1 has none). We instead
+    force foreground in each sample with the probability that STUNetTrainer_huge uses per batch, so the expected
+    number of forced foreground patches per optimizer step stays the same, but it varies from step to step
+    - with batch_dice, the Dice loss is computed over each micro batch and not over the whole effective batch
+    """
+    num_grad_accumulation_steps = 2
+    probabilistic_oversampling = True
+
+    def __init__(self, plans: dict, configuration: str, fold: int, dataset_json: dict, unpack_dataset: bool = True,
+                 device: torch.device = torch.device('cuda')):
+        super().__init__(plans, configuration, fold, dataset_json, unpack_dataset, device)
+        assert self.batch_size % self.num_grad_accumulation_steps == 0, \
+            f'batch size ({self.batch_size}) must be divisible by num_grad_accumulation_steps ' \
+            f'({self.num_grad_accumulation_steps})'
+        # fraction of forced foreground samples in the full batch, rounded the same way as the data loader does it
+        num_forced_fg = self.batch_size - round(self.batch_size * (1 - self.oversample_foreground_percent))
+        self.oversample_foreground_percent = num_forced_fg / self.batch_size
+        self.batch_size //= self.num_grad_accumulation_steps
+        self.num_iterations_per_epoch *= self.num_grad_accumulation_steps
+        self.num_val_iterations_per_epoch *= self.num_grad_accumulation_steps
+
+
 class Decoder(nn.Module):
     def __init__(self):
         super().__init__()
@@ -186,17 +248,24 @@ class Decoder(nn.Module):
 
 
 class STUNet(nn.Module):
-    def __init__(self, input_channels, num_classes, depth=[1, 1, 1, 1, 1, 1], dims=[32, 64, 128, 256, 512, 512],
-                 pool_op_kernel_sizes=None, conv_kernel_sizes=None, enable_deep_supervision=True):
+    def __init__(self, input_channels, num_classes, depth=(1, 1, 1, 1, 1, 1), dims=(32, 64, 128, 256, 512, 512),
+                 pool_op_kernel_sizes=None, conv_kernel_sizes=None, enable_deep_supervision=True,
+                 checkpoint_levels=(), num_deep_supervision_outputs=None):
         super().__init__()
+        if isinstance(depth, int):
+            depth = [depth] * len(dims)
+        assert len(depth) == len(dims), 'need one depth entry per stage'
         self.conv_op = nn.Conv3d
         self.input_channels = input_channels
         self.num_classes = num_classes
 
-        self.final_nonlin = lambda x: x
         self.decoder = Decoder()
         self.decoder.deep_supervision = enable_deep_supervision
-        self.upscale_logits = False
+
+        # resolution levels (0 = full resolution) whose encoder and decoder stages don't store activations but recompute
+        # them during backward. Activation memory shrinks ~4x per level while compute only halves, so the highest
+        # resolution levels give by far the most memory per recomputed FLOP
+        self.checkpoint_levels = set(checkpoint_levels)
 
         self.pool_op_kernel_sizes = pool_op_kernel_sizes
         self.conv_kernel_sizes = conv_kernel_sizes
@@ -210,17 +279,11 @@ class STUNet(nn.Module):
 
         # encoder
         self.conv_blocks_context = nn.ModuleList()
-        stage = nn.Sequential(
-            BasicResBlock(input_channels, dims[0], self.conv_kernel_sizes[0], self.conv_pad_sizes[0], use_1x1conv=True),
-            *[BasicResBlock(dims[0], dims[0], self.conv_kernel_sizes[0], self.conv_pad_sizes[0]) for _ in
-              range(depth[0] - 1)])
-        self.conv_blocks_context.append(stage)
+        self.conv_blocks_context.append(make_res_stage(input_channels, dims[0], depth[0], self.conv_kernel_sizes[0],
+                                                       self.conv_pad_sizes[0]))
         for d in range(1, num_pool + 1):
-            stage = nn.Sequential(BasicResBlock(dims[d - 1], dims[d], self.conv_kernel_sizes[d], self.conv_pad_sizes[d],
-                                                stride=self.pool_op_kernel_sizes[d - 1], use_1x1conv=True),
-                                  *[BasicResBlock(dims[d], dims[d], self.conv_kernel_sizes[d], self.conv_pad_sizes[d])
-                                    for _ in range(depth[d] - 1)])
-            self.conv_blocks_context.append(stage)
+            self.conv_blocks_context.append(make_res_stage(dims[d - 1], dims[d], depth[d], self.conv_kernel_sizes[d],
+                                                           self.conv_pad_sizes[d], self.pool_op_kernel_sizes[d - 1]))
 
         # upsample_layers
         self.upsample_layers = nn.ModuleList()
@@ -231,42 +294,51 @@ class STUNet(nn.Module):
         # decoder
         self.conv_blocks_localization = nn.ModuleList()
         for u in range(num_pool):
-            stage = nn.Sequential(BasicResBlock(dims[-2 - u] * 2, dims[-2 - u], self.conv_kernel_sizes[-2 - u],
-                                                self.conv_pad_sizes[-2 - u], use_1x1conv=True),
-                                  *[BasicResBlock(dims[-2 - u], dims[-2 - u], self.conv_kernel_sizes[-2 - u],
-                                                  self.conv_pad_sizes[-2 - u]) for _ in range(depth[-2 - u] - 1)])
-            self.conv_blocks_localization.append(stage)
+            self.conv_blocks_localization.append(make_res_stage(dims[-2 - u] * 2, dims[-2 - u], depth[-2 - u],
+                                                                self.conv_kernel_sizes[-2 - u],
+                                                                self.conv_pad_sizes[-2 - u]))
 
         # outputs
         self.seg_outputs = nn.ModuleList()
         for ds in range(len(self.conv_blocks_localization)):
             self.seg_outputs.append(nn.Conv3d(dims[-2 - ds], num_classes, kernel_size=1))
-
-        self.upscale_logits_ops = []
-        for usl in range(num_pool - 1):
-            self.upscale_logits_ops.append(lambda x: x)
+        # with deep supervision we only run the seg heads of the num_deep_supervision_outputs highest resolutions. The
+        # remaining heads are kept so that the state dict (and pretrained weights) does not depend on this setting
+        if num_deep_supervision_outputs is None:
+            num_deep_supervision_outputs = num_pool
+        self.first_deep_supervision_stage = num_pool - min(num_deep_supervision_outputs, num_pool)
 
     def forward(self, x):
         skips = []
         seg_outputs = []
 
-        for d in range(len(self.conv_blocks_context) - 1):
-            x = self.conv_blocks_context[d](x)
+        *encoder_stages, bottleneck = self.conv_blocks_context
+        for level, stage in enumerate(encoder_stages):
+            x = self._run_stage(stage, x, level)
             skips.append(x)
 
-        x = self.conv_blocks_context[-1](x)
+        x = self._run_stage(bottleneck, x, len(encoder_stages))
 
-        for u in range(len(self.conv_blocks_localization)):
-            x = self.upsample_layers[u](x)
-            x = torch.cat((x, skips[-(u + 1)]), dim=1)
-            x = self.conv_blocks_localization[u](x)
-            seg_outputs.append(self.final_nonlin(self.seg_outputs[u](x)))
+        for u, (upsample, stage, seg_output) in enumerate(zip(self.upsample_layers, self.conv_blocks_localization,
+                                                              self.seg_outputs)):
+            x = upsample(x)
+            # pop the skip so that we no longer hold a reference once it is consumed. Without autograd (inference)
+            # this frees the high resolution encoder features before the next, larger decoder stage runs
+            x = torch.cat((x, skips.pop()), dim=1)
+            x = self._run_stage(stage, x, len(skips))
+            if self.decoder.deep_supervision and u >= self.first_deep_supervision_stage:
+                seg_outputs.append(seg_output(x))
 
         if self.decoder.deep_supervision:
-            return tuple([seg_outputs[-1]] + [i(j) for i, j in
-                                              zip(list(self.upscale_logits_ops)[::-1], seg_outputs[:-1][::-1])])
+            return tuple(seg_outputs[::-1])
         else:
-            return seg_outputs[-1]
+            # without deep supervision only the highest resolution head is needed, don't run the others
+            return self.seg_outputs[-1](x)
+
+    def _run_stage(self, stage, x, level):
+        if level in self.checkpoint_levels and torch.is_grad_enabled():
+            return checkpoint(stage, x, use_reentrant=False)
+        return stage(x)
 
 
 class BasicResBlock(nn.Module):
@@ -280,21 +352,27 @@ class BasicResBlock(nn.Module):
         self.norm2 = nn.InstanceNorm3d(output_channels, affine=True)
         self.act2 = nn.LeakyReLU(inplace=True)
 
+        # the residual path is decided at construction time so that forward has no branches
         if use_1x1conv:
             self.conv3 = nn.Conv3d(input_channels, output_channels, kernel_size=1, stride=stride)
         else:
-            self.conv3 = None
+            self.conv3 = nn.Identity()
 
     def forward(self, x):
         y = self.conv1(x)
         y = self.act1(self.norm1(y))
         y = self.norm2(self.conv2(y))
-        if self.conv3:
-            x = self.conv3(x)
-        y += x
+        y += self.conv3(x)
         return self.act2(y)
 
 
+def make_res_stage(input_channels, output_channels, num_blocks, kernel_size, padding, stride=1):
+    # the first block changes the number of channels (and resolution), the remaining ones keep it
+    return nn.Sequential(
+        BasicResBlock(input_channels, output_channels, kernel_size, padding, stride=stride, use_1x1conv=True),
+        *(BasicResBlock(output_channels, output_channels, kernel_size, padding) for _ in range(num_blocks - 1)))
+
+
 class Upsample_Layer_nearest(nn.Module):
     def __init__(self, input_channels, output_channels, pool_op_kernel_size, mode='nearest'):
         super().__init__()
@@ -303,6 +381,9 @@ class Upsample_Layer_nearest(nn.Module):
         self.mode = mode
 
     def forward(self, x):
-        x = nn.functional.interpolate(x, scale_factor=self.pool_op_kernel_size, mode=self.mode)
+        # a 1x1 conv commutes with nearest upsampling, so we apply it at the low resolution. Same result, but the conv
+        # runs on prod(pool_op_kernel_size)x fewer voxels and no full resolution intermediate with input_channels is
+        # allocated
         x = self.conv(x)
+        x = nn.functional.interpolate(x, scale_factor=self.pool_op_kernel_size, mode=self.mode)
         return x
\ No newline at end of file
@@ -66,6 +66,13 @@ from nnunetv2.training.nnUNetTrainer.nnUNetTrainer import nnUNetTrainer
 
 
 class nnUNetTrainer_window(nnUNetTrainer):
+    # gradients of this many train_step calls are accumulated before each optimizer step. Must divide
+    # num_iterations_per_epoch so that no partially accumulated gradients are left over at the end of an epoch
+    num_grad_accumulation_steps = 1
+    # if True, the data loaders force foreground in each sample with probability oversample_foreground_percent instead
+    # of in the last round(batch_size * oversample_foreground_percent) samples of every batch
+    probabilistic_oversampling = False
+
     def __init__(self, plans: dict, configuration: str, fold: int, dataset_json: dict, unpack_dataset: bool = True,
                  device: torch.device = torch.device('cuda')):
         # From https://grugbrain.dev/. Worth a read ya big brains ;-)
@@ -148,6 +155,10 @@ class nnUNetTrainer_window(nnUNetTrainer):
         self.num_epochs = 1000
         self.current_epoch = 0
         self.enable_deep_supervision = True
+        self.compile_mode = None  # passed to torch.compile, None is the torch default
+        self.compile_dynamic = None  # passed to torch.compile. False specializes on every input shape
+        self.ddp_kwargs = {}  # passed to DistributedDataParallel
+        self._num_accumulated_steps = 0  # train_step calls since the last optimizer step
 
         ### Dealing with labels/regions
         self.label_manager = self.plans_manager.get_label_manager(dataset_json)
@@ -158,6 +169,7 @@ class nnUNetTrainer_window(nnUNetTrainer):
         self.network = None  # -> self.build_network_architecture()
         self.optimizer = self.lr_scheduler = None  # -> self.initialize
         self.grad_scaler = GradScaler() if self.device.type == 'cuda' else None
+        self.autocast_dtype = torch.float16  # only used on cuda, see train_step
         self.loss = None  # -> self.initialize
 
         ### Simple logging. Don't take that away from me!
@@ -213,13 +225,13 @@ class nnUNetTrainer_window(nnUNetTrainer):
             # compile network for free speedup
             if self._do_i_compile():
                 self.print_to_log_file('Using torch.compile...')
-                self.network = torch.compile(self.network)
+                self.network = torch.compile(self.network, mode=self.compile_mode, dynamic=self.compile_dynamic)
 
             self.optimizer, self.lr_scheduler = self.configure_optimizers()
             # if ddp, wrap in DDP wrapper
             if self.is_ddp:
                 self.network = torch.nn.SyncBatchNorm.convert_sync_batchnorm(self.network)
-                self.network = DDP(self.network, device_ids=[self.local_rank])
+                self.network = DDP(self.network, device_ids=[self.local_rank], **self.ddp_kwargs)
 
             self.loss = self._build_loss()
             self.was_initialized = True
@@ -632,12 +644,13 @@ class nnUNetTrainer_window(nnUNetTrainer):
             mt_gen_val = SingleThreadedAugmenter(dl_val, val_transforms)
         else:
             mt_gen_train = LimitedLenWrapper(self.num_iterations_per_epoch, data_loader=dl_tr, transform=tr_transforms,
-                                             num_processes=allowed_num_processes, num_cached=6, seeds=None,
-                                             pin_memory=self.device.type == 'cuda', wait_time=0.02)
+                                             num_processes=allowed_num_processes,
+                                             num_cached=max(6, allowed_num_processes // 2), seeds=None,
+                                             pin_memory=self.device.type == 'cuda', wait_time=0.002)
             mt_gen_val = LimitedLenWrapper(self.num_val_iterations_per_epoch, data_loader=dl_val,
                                            transform=val_transforms, num_processes=max(1, allowed_num_processes // 2),
-                                           num_cached=3, seeds=None, pin_memory=self.device.type == 'cuda',
-                                           wait_time=0.02)
+                                           num_cached=max(3, allowed_num_processes // 4), seeds=None,
+                                           pin_memory=self.device.type == 'cuda', wait_time=0.002)
         return mt_gen_train, mt_gen_val
 
     def get_plain_dataloaders(self, initial_patch_size: Tuple[int, ...], dim: int):
@@ -649,26 +662,30 @@ class nnUNetTrainer_window(nnUNetTrainer):
                                        self.configuration_manager.patch_size,
                                        self.label_manager,
                                        oversample_foreground_percent=self.oversample_foreground_percent,
-                                       sampling_probabilities=None, pad_sides=None)
+                                       sampling_probabilities=None, pad_sides=None,
+                                       probabilistic_oversampling=self.probabilistic_oversampling)
             dl_val = nnUNetDataLoader2D(dataset_val, self.batch_size,
                                         self.configuration_manager.patch_size,
                                         self.configuration_manager.patch_size,
                                         self.label_manager,
                                         oversample_foreground_percent=self.oversample_foreground_percent,
-                                        sampling_probabilities=None, pad_sides=None)
+                                        sampling_probabilities=None, pad_sides=None,
+                                        probabilistic_oversampling=self.probabilistic_oversampling)
         else:
             dl_tr = nnUNetDataLoader3D(dataset_tr, self.batch_size,
                                        initial_patch_size,
                                        self.configuration_manager.patch_size,
                                        self.label_manager,
                                        oversample_foreground_percent=self.oversample_foreground_percent,
-                                       sampling_probabilities=None, pad_sides=None)
+                                       sampling_probabilities=None, pad_sides=None,
+                                       probabilistic_oversampling=self.probabilistic_oversampling)
             dl_val = nnUNetDataLoader3D(dataset_val, self.batch_size,
                                         self.configuration_manager.patch_size,
                                         self.configuration_manager.patch_size,
                                         self.label_manager,
                                         oversample_foreground_percent=self.oversample_foreground_percent,
-                                        sampling_probabilities=None, pad_sides=None)
+                                        sampling_probabilities=None, pad_sides=None,
+                                        probabilistic_oversampling=self.probabilistic_oversampling)
         return dl_tr, dl_val
 
     @staticmethod
@@ -813,6 +830,10 @@ class nnUNetTrainer_window(nnUNetTrainer):
         if not self.was_initialized:
             self.initialize()
 
+        assert self.num_iterations_per_epoch % self.num_grad_accumulation_steps == 0, \
+            f'num_iterations_per_epoch ({self.num_iterations_per_epoch}) must be divisible by ' \
+            f'num_grad_accumulation_steps ({self.num_grad_accumulation_steps})'
+
         maybe_mkdir_p(self.output_folder)
 
         # make sure deep supervision is on in the network
@@ -877,6 +898,8 @@ class nnUNetTrainer_window(nnUNetTrainer):
 
     def on_train_epoch_start(self):
         self.network.train()
+        # every epoch starts with fresh gradients, never with ones accumulated before validation or checkpointing
+        self._num_accumulated_steps = 0
         self.lr_scheduler.step(self.current_epoch)
         self.print_to_log_file('')
         self.print_to_log_file(f'Epoch {self.current_epoch}')
@@ -902,27 +925,40 @@ class nnUNetTrainer_window(nnUNetTrainer):
         else:
             target = target.to(self.device, non_blocking=True)
 
-        self.optimizer.zero_grad(set_to_none=True)
-        # Autocast is a little bitch.
-        # If the device_type is 'cpu' then it's slow as heck and needs to be disabled.
-        # If the device_type is 'mps' then it will complain that mps is not implemented, even if enabled=False is set. Whyyyyyyy. (this is why we don't make use of enabled=False)
-        # So autocast will only be active if we have a cuda device.
-        with autocast(self.device.type, enabled=True) if self.device.type == 'cuda' else dummy_context():
-            data = self.make_windows(data)
-            output = self.network(data)
-            # del data
-            l = self.loss(output, target)
-
-        if self.grad_scaler is not None:
-            self.grad_scaler.scale(l).backward()
-            self.grad_scaler.unscale_(self.optimizer)
-            torch.nn.utils.clip_grad_norm_(self.network.parameters(), 12)
-            self.grad_scaler.step(self.optimizer)
-            self.grad_scaler.update()
-        else:
-            l.backward()
-            torch.nn.utils.clip_grad_norm_(self.network.parameters(), 12)
-            self.optimizer.step()
+        if self._num_accumulated_steps == 0:
+            self.optimizer.zero_grad(set_to_none=True)
+        self._num_accumulated_steps += 1
+        do_optimizer_step = self._num_accumulated_steps == self.num_grad_accumulation_steps
+        # with DDP, gradients only need to be allreduced for the micro step that is followed by an optimizer step
+        sync_context = self.network.no_sync() if self.is_ddp and not do_optimizer_step else dummy_context()
+
+        with sync_context:
+            # Autocast is a little bitch.
+            # If the device_type is 'cpu' then it's slow as heck and needs to be disabled.
+            # If the device_type is 'mps' then it will complain that mps is not implemented, even if enabled=False is set. Whyyyyyyy. (this is why we don't make use of enabled=False)
+            # So autocast will only be active if we have a cuda device.
+            with autocast(self.device.type, dtype=self.autocast_dtype, enabled=True) if self.device.type == 'cuda' else dummy_context():
+                data = self.make_windows(data)
+                output = self.network(data)
+                # del data
+                l = self.loss(output, target)
+
+            l_backward = l / self.num_grad_accumulation_steps
+            if self.grad_scaler is not None:
+                self.grad_scaler.scale(l_backward).backward()
+            else:
+                l_backward.backward()
+
+        if do_optimizer_step:
+            self._num_accumulated_steps = 0
+            if self.grad_scaler is not None:
+                self.grad_scaler.unscale_(self.optimizer)
+                torch.nn.utils.clip_grad_norm_(self.network.parameters(), 12)
+                self.grad_scaler.step(self.optimizer)
+                self.grad_scaler.update()
+            else:
+                torch.nn.utils.clip_grad_norm_(self.network.parameters(), 12)
+                self.optimizer.step()
         return {'loss': l.detach().cpu().numpy()}
 
     def on_train_epoch_end(self, train_outputs: List[dict]):
@@ -954,7 +990,7 @@ class nnUNetTrainer_window(nnUNetTrainer):
         # If the device_type is 'cpu' then it's slow as heck and needs to be disabled.
         # If the device_type is 'mps' then it will complain that mps is not implemented, even if enabled=False is set. Whyyyyyyy. (this is why we don't make use of enabled=False)
         # So autocast will only be active if we have a cuda device.
-        with autocast(self.device.type, enabled=True) if self.device.type == 'cuda' else dummy_context():
+        with autocast(self.device.type, dtype=self.autocast_dtype, enabled=True) if self.device.type == 'cuda' else dummy_context():
             data = self.make_windows(data)
             output = self.network(data)
             del data
@@ -1147,7 +1183,15 @@ class nnUNetTrainer_window(nnUNetTrainer):
         predictor = nnUNetPredictor(tile_step_size=0.5, use_gaussian=True, use_mirroring=True,
                                     perform_everything_on_device=True, device=self.device, verbose=False,
                                     verbose_preprocessing=False, allow_tqdm=False)
-        predictor.manual_initialization(self.network, self.plans_manager, self.configuration_manager, None,
+        # with mirroring, the predictor accumulates the outputs of several forward passes. The CUDA graphs of
+        # reduce-overhead and max-autotune overwrite the outputs of the previous call on every no_grad call, so in that
+        # case the predictor gets the uncompiled network (and compiles it without CUDA graphs if nnUNet_compile is set)
+        network = self.network
+        if self.compile_mode in ('reduce-overhead', 'max-autotune'):
+            network = network.module if self.is_ddp else network
+            if isinstance(network, OptimizedModule):
+                network = network._orig_mod
+        predictor.manual_initialization(network, self.plans_manager, self.configuration_manager, None,
                                         self.dataset_json, self.__class__.__name__,
                                         self.inference_allowed_mirroring_axes)
 